@@ -1,102 +1,268 @@
 #! /usr/bin/python
 
 import time
-import consul
+import Queue
+import operator
 import socket
 import MySQLdb
 import MySQLdb.cursors
+from MySQLdb.constants import ER
 import logging
 import argparse
 import warnings
-import threading
 
-from consulfailover import start_handler
+from consul.base import ConsulException
+from consulfailover import consul_client, start_handler
+
+
+# MySQLdb escapes the parameters, so the replication password is never
+# spliced into the statement by hand
+_CHANGE_MASTER = 'CHANGE MASTER TO MASTER_HOST=%s, MASTER_PORT=%s, MASTER_USER=%s, MASTER_PASSWORD=%s, MASTER_AUTO_POSITION=1'
+
+# The replica status columns used below, read from the performance_schema
+# tables (MySQL 5.7+) instead of the ~60 columns of SHOW SLAVE STATUS. Older
+# servers, or servers running without performance_schema, fall back to
+# SHOW SLAVE STATUS, which has the same column names.
+_SLAVE_STATUS = (
+    "SELECT c.HOST AS Master_Host, "
+    "IF(s.SERVICE_STATE = 'ON', 'Yes', 'No') AS Slave_IO_Running, "
+    "IF(a.SERVICE_STATE = 'ON', 'Yes', 'No') AS Slave_SQL_Running "
+    "FROM performance_schema.replication_connection_configuration c "
+    "JOIN performance_schema.replication_connection_status s USING (CHANNEL_NAME) "
+    "JOIN performance_schema.replication_applier_status a USING (CHANNEL_NAME)"
+)
+_SHOW_SLAVE_STATUS = 'SHOW SLAVE STATUS'
+
+# Errors meaning the performance_schema tables cannot be used at all: they
+# are missing (e.g. MariaDB) or the user lacks SELECT on them, which
+# SHOW SLAVE STATUS does not need
+_NO_SLAVE_STATUS_TABLES = frozenset([
+    ER.NO_SUCH_TABLE,
+    ER.BAD_FIELD_ERROR,
+    ER.TABLEACCESS_DENIED_ERROR,
+    ER.COLUMNACCESS_DENIED_ERROR,
+    ER.DBACCESS_DENIED_ERROR,
+])
+_get_slave_threads = operator.itemgetter('Slave_IO_Running', 'Slave_SQL_Running')
+
+
+def _fetch_all(cursor):
+    """Return the rows of the statement run on cursor: a single row as
+       a dict, several rows as a list, or {} if there were none
+    """
+
+    res = cursor.fetchall()
+
+    if res and len(res) == 1:
+        return res[0]
+    elif res:
+        return res
+
+    return {}
+
+
+def _fetch_one(cursor):
+    """Return the first row on cursor as a dict, or {} if there was none"""
+
+    row = cursor.fetchone()
+
+    # A server-side cursor must be drained before the connection is reused
+    cursor.fetchall()
+
+    return row or {}
+
+
+def _fetch_ok(cursor):
+    """Drain the rows on cursor and report that the statement ran"""
+
+    cursor.fetchall()
+    return True
 
 
 class Mysql(object):
     """Manage MySQL"""
 
-    def __init__(self, port, defaults_file, replication_user, replication_password, require_databases):
+    def __init__(self, port, defaults_file, replication_user, replication_password, require_databases, grace_ticks=3, pool_size=4, pool_timeout=5):
         self.port = port
         self.defaults_file = defaults_file
         self.replication_user = replication_user
         self.replication_password = replication_password
         self.require_databases = require_databases
-        self.consul = consul.Consul()
+        self._required_dbs = frozenset(require_databases)
+        self._required_dbs_joined = ', '.join(require_databases)
+        self.grace_ticks = grace_ticks
+        self.pool_timeout = pool_timeout
+        self.consul = consul_client()
         self.logger = logging.getLogger('ConsulFailover')
-        self.connect_lock = threading.Lock()
-        self.query_lock = threading.Lock()
-        self.conn = None
-        self.connect()
+        self._hostname = socket.gethostname()
+        self._transactions_key = 'mysql/{}/transactions'.format(self._hostname)
+        self._last_leader_index = {}
+        self._wrong_master_streak = 0
+        self._pending_master = None
+        self._next_reconnect_at = 0
+        self._reconnect_backoff = 0.25
+        self._slave_status_query = None
 
-    def connect(self):
-        """Connect or get existing connection to MySQL"""
+        # CHANGE MASTER TO and STOP SLAVE routinely raise harmless warnings
+        warnings.filterwarnings('ignore', category=MySQLdb.Warning)
 
-        if not self.connect_lock.acquire(False):
-            self.logger.info('Failed to get connect lock!')
-            return False
+        # Connections that could not be opened are kept in the pool as None
+        # and reopened the next time they are checked out
+        self.pool = Queue.Queue(maxsize=pool_size)
+
+        for _ in range(pool_size):
+            self.pool.put(self._reconnect())
+
+        self.get_slave_status_query()
+
+    def connect(self):
+        """Open a new connection to MySQL"""
 
         try:
-            self.conn = MySQLdb.connect(read_default_file=self.defaults_file, cursorclass=MySQLdb.cursors.DictCursor)
+            conn = MySQLdb.connect(read_default_file=self.defaults_file, cursorclass=MySQLdb.cursors.DictCursor)
         except Exception as e:
             self.logger.info('Error connecting to MySQL: {}'.format(e))
-            self.conn = None
-            return False
-        finally:
-            self.connect_lock.release()
+            return None
 
         self.logger.info('Connected to MySQL on port {}'.format(self.port))
-        return True
+        return conn
+
+    def _reconnect(self):
+        """Open a connection to replace a missing one, backing off
+           exponentially (up to 5 seconds) while MySQL is unreachable
+        """
+
+        if time.time() < self._next_reconnect_at:
+            return None
 
-    def query(self, query):
+        conn = self.connect()
+
+        if conn:
+            self._reconnect_backoff = 0.25
+        else:
+            self._next_reconnect_at = time.time() + self._reconnect_backoff
+            self._reconnect_backoff = min(self._reconnect_backoff * 2, 5)
+
+        return conn
+
+    def query(self, query, params=None):
         """Perform a MySQL query"""
 
-        # Attempt to reconnect to MySQL if there is no connection
-        if not self.conn and not self.connect():
-            return {}
+        return self.query_many([query], [params])
 
-        if not self.query_lock.acquire():
-            self.logger.info('Failed to get query lock!')
-            return {}
+    def query_one(self, query, params=None):
+        """Perform a MySQL query that returns at most one row of interest,
+           streaming it with a server-side cursor and returning only that row
+        """
+
+        return self._execute([query], [params], _fetch_one, MySQLdb.cursors.SSDictCursor)
+
+    def query_many(self, queries, params_list=None):
+        """Perform a sequence of MySQL queries on a single pooled connection
+           and return the result of the last one. Statements that depend on
+           session state (e.g. FLUSH TABLES WITH READ LOCK ... UNLOCK TABLES)
+           must be run together through this method. params_list optionally
+           holds the parameters for each query.
+        """
+
+        return self._execute(queries, params_list, _fetch_all)
+
+    def _execute(self, queries, params_list, fetch, cursorclass=None, reraise=False):
+        """Run queries one after another on a pooled connection and return
+           fetch(cursor) for the last one, or {} if they could not be run.
+           If reraise is set, errors raised by the queries are passed on.
+        """
 
-        if query.startswith('CHANGE MASTER TO') or query.startswith('STOP SLAVE'):
-            warnings.filterwarnings('ignore', category=MySQLdb.Warning)
+        params_list = params_list or [None] * len(queries)
 
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(query)
-        # Attempt to reconnect to MySQL if the connection has been lost
-        except MySQLdb.OperationalError as e:
-            self.logger.info('Connection failed during query: {}'.format(e))
-            self.connect()
+            conn = self.pool.get(timeout=self.pool_timeout)
+        except Queue.Empty:
+            self.logger.info('Timed out waiting for a MySQL connection')
             return {}
+
+        try:
+            # Attempt to reconnect to MySQL if there is no connection
+            if not conn:
+                conn = self._reconnect()
+
+            if not conn:
+                return {}
+
+            # Statements are executed separately rather than as one
+            # multi-statement batch, because MySQLdb reads warnings after each
+            # execute() and would fall out of sync with unread results
+            cursor = conn.cursor(cursorclass)
+
+            for query, params in zip(queries, params_list):
+                cursor.execute(query, params)
+
+            return fetch(cursor)
+        # Drop the connection after any failure, since it may have been lost
+        # or left with unread results; it is reopened on its next checkout
         except Exception as e:
-            self.logger.info('Query failed: "{}": {}'.format(query, e))
-            return {}
-        # Make sure to release the connection if we got one
-        finally:
-            self.query_lock.release()
+            if isinstance(e, MySQLdb.OperationalError):
+                self.logger.info('Connection failed during query: {}'.format(e))
+            else:
+                self.logger.info('Query failed: "{}": {}'.format('; '.join(queries), e))
+
+            try:
+                conn.close()
+            except Exception:
+                pass
 
-        res = cursor.fetchall()
+            conn = None
 
-        if res and len(res) == 1:
-            return res[0]
-        elif res:
-            return res
+            if reraise:
+                raise
 
-        return {}
+            return {}
+        # Always return the connection slot to the pool
+        finally:
+            self.pool.put(conn)
 
     def get_variable(self, variable):
         """Get a MySQL variable and return the value"""
 
-        res = self.query('SELECT @@{}'.format(variable))
+        res = self.query_one('SELECT @@{}'.format(variable))
 
         return res.get('@@{}'.format(variable))
 
+    def get_slave_status_query(self):
+        """Return the query used to read replica status. Whether the
+           performance_schema tables can be read is checked by running the
+           query once; until that check gets an answer from MySQL,
+           SHOW SLAVE STATUS is used.
+        """
+
+        if self._slave_status_query:
+            return self._slave_status_query
+
+        enabled = self.get_variable('GLOBAL.performance_schema')
+
+        if enabled is None:
+            return _SHOW_SLAVE_STATUS
+
+        # The tables exist but stay empty while performance_schema is off
+        if not enabled:
+            self.logger.info('performance_schema is disabled, using SHOW SLAVE STATUS')
+            self._slave_status_query = _SHOW_SLAVE_STATUS
+            return self._slave_status_query
+
+        try:
+            if self._execute([_SLAVE_STATUS], None, _fetch_ok, MySQLdb.cursors.SSDictCursor, reraise=True):
+                self._slave_status_query = _SLAVE_STATUS
+        except Exception as e:
+            if isinstance(e, MySQLdb.Error) and e.args and e.args[0] in _NO_SLAVE_STATUS_TABLES:
+                self.logger.info('Unable to read performance_schema replication tables, using SHOW SLAVE STATUS')
+                self._slave_status_query = _SHOW_SLAVE_STATUS
+
+        return self._slave_status_query or _SHOW_SLAVE_STATUS
+
     def post_transactions(self):
         """Post the list of executed transactions to Consul"""
 
-        res = self.query('SELECT @@GLOBAL.GTID_EXECUTED AS transactions')
+        res = self.query_one('SELECT @@GLOBAL.GTID_EXECUTED AS transactions')
 
         if not res.get('transactions'):
             self.logger.debug('No transactions listed in GTID_EXECUTED')
@@ -104,29 +270,38 @@ class Mysql(object):
 
         transactions = res['transactions'].replace('\n', '')
         self.logger.debug('Posting transactions to Consul: {}'.format(transactions))
-        self.consul.kv.put('mysql/{}/transactions'.format(socket.gethostname()), value=transactions)
+        self.consul.kv.put(self._transactions_key, value=transactions)
 
     def get_leader_transactions(self, master_host):
-        """Get the transactions that have been executed on the master"""
+        """Get the transactions that have been executed on the master. Once
+           the master's key has been seen, wait up to a second for it to be
+           updated by the master instead of always sleeping for gossip.
+        """
 
-        res = self.consul.kv.get('mysql/{}/transactions'.format(master_host))
+        key = 'mysql/{}/transactions'.format(master_host)
 
-        if not res or not res[1]:
+        try:
+            index, data = self.consul.kv.get(key, index=self._last_leader_index.get(master_host), wait='1s')
+        except ConsulException as e:
+            self.logger.info('Error getting transactions for {}: {}'.format(master_host, e))
             return
 
-        return res[1].get('Value')
+        self._last_leader_index[master_host] = index
+
+        if not data:
+            return
+
+        return data.get('Value')
 
     def master_is_ahead(self, master_host):
         """Test whether the master has transactions that this slave hasn't executed yet"""
 
-        # Gossip pause
-        time.sleep(1)
         master_transactions = self.get_leader_transactions(master_host)
 
         if not master_transactions:
             return False
 
-        res = self.query('SELECT GTID_SUBTRACT("{}", @@GLOBAL.GTID_EXECUTED) as leftovers'.format(master_transactions))
+        res = self.query_one('SELECT GTID_SUBTRACT(%s, @@GLOBAL.GTID_EXECUTED) as leftovers', (master_transactions,))
 
         if res and res.get('leftovers'):
             return True
@@ -139,25 +314,33 @@ class Mysql(object):
         res = self.query('SHOW DATABASES')
 
         try:
-            databases = [x['Database'] for x in res]
+            databases = {x['Database'] for x in res}
         except:
             return False, 'Error running SHOW DATABASES: {}'.format(res)
 
         if not databases:
             return False, 'SHOW DATABASES query failed'
 
-        missing_databases = set(self.require_databases) - set(databases)
+        missing_databases = self._required_dbs - databases
 
         if missing_databases:
             return False, 'The following databases are missing on this server: {}'.format(', '.join(missing_databases))
 
-        return True, 'MySQL serving required databases: {}'.format(', '.join(self.require_databases))
+        return True, 'MySQL serving required databases: {}'.format(self._required_dbs_joined)
+
+    def reset_master_switch(self):
+        """Forget any master switch that ensure_slave() was waiting on"""
+
+        self._wrong_master_streak = 0
+        self._pending_master = None
 
     def ensure_master(self):
         """Make sure this host is configured as the master"""
 
+        # A later switch to being a slave must wait out its own grace period
+        self.reset_master_switch()
         self.post_transactions()
-        slave_status = self.query('SHOW SLAVE STATUS')
+        slave_status = self.query_one(self.get_slave_status_query())
 
         # Make sure the master is read-write
         if self.get_variable('read_only') != 0:
@@ -168,37 +351,58 @@ class Mysql(object):
         if slave_status:
 
             # Don't stop slave if the old master is ahead and still alive
-            if slave_status.get('Master_Host') and slave_status['Master_Host'] != socket.gethostname() and self.master_is_ahead(slave_status['Master_Host']):
+            if slave_status.get('Master_Host') and slave_status['Master_Host'] != self._hostname and self.master_is_ahead(slave_status['Master_Host']):
                 self.logger.info('{} is still ahead, waiting to catch up...'.format(slave_status['Master_Host']))
                 return
 
             self.logger.info('Stopping slave threads')
-            self.query('STOP SLAVE')
-            self.query('RESET SLAVE ALL')
+            self.query_many(['STOP SLAVE', 'RESET SLAVE ALL'])
 
     def ensure_slave(self, master_host):
         """Make sure this host is configured as a slave"""
 
-        slave_status = self.query('SHOW SLAVE STATUS')
+        slave_status = self.query_one(self.get_slave_status_query())
 
         if not type(slave_status) == dict:
             self.logger.info('Error getting slave status: {}'.format(slave_status))
             return False
 
-        # Do a master switch if we are not yet slaving from master_host
+        # Do a master switch if we are not yet slaving from master_host, but
+        # only once that has been the case for grace_ticks checks in a row so
+        # that a transient leader change does not trigger a switch
         if not slave_status or slave_status.get('Master_Host') != master_host:
+
+            # Fence the host straight away though, since another host may
+            # already be accepting writes as the master
+            if self.get_variable('read_only') != 1:
+                self.logger.info('Setting host read-only')
+                self.query_many(['FLUSH LOCAL TABLES WITH READ LOCK', 'SET GLOBAL read_only=1', 'UNLOCK TABLES'])
+
+            if master_host != self._pending_master:
+                self.reset_master_switch()
+                self._pending_master = master_host
+
+            self._wrong_master_streak += 1
+
+            if self._wrong_master_streak < self.grace_ticks:
+                if self._wrong_master_streak == 1:
+                    self.logger.info('Not slaving from {}, waiting {} checks before switching'.format(master_host, self.grace_ticks))
+                return False
+
             self.logger.info('Becoming a slave to {}'.format(master_host))
-            self.query('FLUSH LOCAL TABLES WITH READ LOCK')
-            self.query('SET GLOBAL read_only=1')
-            self.query('UNLOCK TABLES')
-            self.query('STOP SLAVE')
-            self.query('RESET SLAVE ALL')
-            self.query('CHANGE MASTER TO MASTER_HOST="{}", MASTER_PORT={}, MASTER_USER="{}", MASTER_PASSWORD="{}", MASTER_AUTO_POSITION=1'.format(master_host, self.port, self.replication_user, self.replication_password))
-            self.query('START SLAVE')
+            self.query_many([
+                'STOP SLAVE',
+                'RESET SLAVE ALL',
+                _CHANGE_MASTER,
+                'START SLAVE',
+            ], [None, None, (master_host, self.port, self.replication_user, self.replication_password), None])
+            self.reset_master_switch()
             return True
 
+        self.reset_master_switch()
+
         # Try restarting slave threads if they are not running
-        if slave_status.get('Slave_IO_Running') != 'Yes' or slave_status.get('Slave_SQL_Running') != 'Yes':
+        if _get_slave_threads(slave_status) != ('Yes', 'Yes'):
             self.logger.info('Slave threads are not running, trying to restart them')
             self.query('STOP SLAVE')
             self.query('START SLAVE')
@@ -221,11 +425,14 @@ def parse():
     parser.add_argument('-e', '--replication-user', default='replication', help='Username for replication')
     parser.add_argument('-r', '--replication-password', required=True, help='Password for replication')
     parser.add_argument('-l', '--log-level', default='INFO', help='Output level (default: %(default)s)')
-    parser.add_argument('-i', '--check-interval', default='30s', help='Consul check timeout (default: %(default)s)')
+    parser.add_argument('-i', '--check-interval', default='30s', help='Consul check interval (default: %(default)s)')
+    parser.add_argument('-t', '--check-timeout', default='6s', help='Consul check timeout (default: %(default)s)')
+    parser.add_argument('-D', '--check-deregister', help='Deregister the service after its check has been critical for this long (default: never)')
+    parser.add_argument('-g', '--failover-grace-ticks', type=int, default=3, help='Checks in a row a new master must be seen before switching to it (default: %(default)s)')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse()
-    mysql_args = [args.port, args.defaults_file, args.replication_user, args.replication_password, args.require_databases]
-    start_handler(Mysql, mysql_args, args.port, args.api_port, args.cluster_name, args.log_level, args.check_interval)
+    mysql_args = [args.port, args.defaults_file, args.replication_user, args.replication_password, args.require_databases, args.failover_grace_ticks]
+    start_handler(Mysql, mysql_args, args.port, args.api_port, args.cluster_name, args.log_level, args.check_interval, check_timeout=args.check_timeout, check_deregister=args.check_deregister)
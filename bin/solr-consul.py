@@ -1,21 +1,77 @@
 #! /usr/bin/python
 
 import os
-import json
+import stat
 import time
+import errno
+import random
+import select
 import socket
 import logging
-import urllib2
 import argparse
+import requests
+import functools
 import subprocess
 
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 from consulfailover import start_handler
 
 
+def _read_and_compare(path, expected):
+    """Check whether the file at path contains exactly the bytes in expected"""
+
+    fd = os.open(path, os.O_RDONLY)
+
+    # Reading one byte past the expected length is enough to tell a
+    # matching file from a longer one
+    try:
+        return os.read(fd, len(expected) + 1) == expected
+    finally:
+        os.close(fd)
+
+
+def _write_atomic(path, contents):
+    """Replace the file at path with contents so that readers only ever see
+       the old or the new file, never a partially written one. The new file
+       keeps the owner and permissions of the old one, so that Solr can
+       still write to it.
+    """
+
+    tmp_path = path + '.tmp'
+    st = os.stat(path)
+
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(contents)
+            f.flush()
+            os.fchmod(f.fileno(), stat.S_IMODE(st.st_mode))
+            os.fchown(f.fileno(), st.st_uid, st.st_gid)
+            os.fsync(f.fileno())
+
+        os.rename(tmp_path, path)
+    # Don't leave a partial temporary file behind
+    except:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+        raise
+
+    # Make the rename itself durable
+    dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
 class Solr(object):
     """Manage Solr"""
 
-    def __init__(self, port, base_uri, base_dir, restart_timeout=300, restart_flag_file='/var/tmp/solr_restart'):
+    def __init__(self, port, base_uri, base_dir, restart_timeout=300, restart_flag_file='/var/tmp/solr_restart', io_threads=8):
 
         self.port = port
         self.base_uri = base_uri
@@ -23,29 +79,31 @@ class Solr(object):
         self.restart_timeout = restart_timeout
         self.restart_flag_file = restart_flag_file
         self.logger = logging.getLogger('ConsulFailover')
+        self._properties_files = None
+
+        # Check and rewrite core.properties files in parallel
+        self._io_pool = ThreadPool(io_threads)
+
+        # Keep the connection to the local Solr API alive between health checks
+        self.http = requests.Session()
+        self.http.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=2))
 
     def flag_restart(self):
-        """Flag the time of a master restart"""
+        """Flag the time of a master restart by touching the restart flag file"""
 
-        with open(self.restart_flag_file, 'w') as f:
-            f.write(str(time.time()))
+        with open(self.restart_flag_file, 'a'):
+            os.utime(self.restart_flag_file, None)
 
     def is_restarting(self):
-        """Check the timestamp of a restart to see if this host is still allowed
+        """Check the age of the restart flag to see if this host is still allowed
            to be restarting
         """
 
-        if not os.path.exists(self.restart_flag_file):
-            return False
-
-        with open(self.restart_flag_file, 'r') as f:
-            restart_time = f.readline()
-
         try:
-            restart_time = float(restart_time)
-        except ValueError:
-            self.logger.info('Invalid timestamp in {}: {}'.format(self.restart_flag_file, restart_time))
-            os.remove(self.restart_flag_file)
+            restart_time = os.stat(self.restart_flag_file).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
             return False
 
         if time.time() - restart_time < self.restart_timeout:
@@ -72,11 +130,12 @@ class Solr(object):
         url = 'http://localhost:{}/{}/admin/cores?action=STATUS&wt=json'.format(self.port, self.base_uri)
 
         try:
-            req = urllib2.urlopen(url, timeout=5)
+            req = self.http.get(url, timeout=5)
+            req.raise_for_status()
         except Exception as e:
             return False, 'Unable to connect to Solr API: {}'.format(e)
 
-        status = json.loads(req.read())
+        status = req.json()
 
         if not status:
             return False, 'Solr API returned empty status'
@@ -103,26 +162,71 @@ class Solr(object):
         args = ['/etc/init.d/tomcat7-solr', init_arg]
         self.logger.info('Bringing solr {0}'.format(want_state))
 
-        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        res = p.communicate()
+        # Solr's health is polled while the init script runs rather than after it
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-        if p.returncode != 0:
-            raise Exception('Error running {0}: {1}'.format(' '.join(args), res))
+        return self.wait_solr(want_state, p)
 
-        return self.wait_solr(want_state)
+    def _read_output(self, proc, output):
+        """Append whatever proc has written to stdout so far to output, without
+           blocking, so the init script cannot stall on a full pipe
+        """
+
+        fd = proc.stdout.fileno()
+
+        while select.select([fd], [], [], 0)[0]:
+            data = os.read(fd, 4096)
 
-    def wait_solr(self, want_state):
-        """Wait for Solr to reach a given state (up or down)"""
+            if not data:
+                break
+
+            output.append(data)
+
+    def _stop_script(self, proc):
+        """Terminate proc, killing it if it has not exited within 5 seconds,
+           and reap it so that a hung script does not overlap the next one
+        """
+
+        proc.terminate()
+        deadline = time.time() + 5
+
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+        proc.stdout.close()
+
+    def wait_solr(self, want_state, proc=None):
+        """Wait for Solr to reach a given state (up or down), polling with
+           exponential backoff so a slow restart is not hammered with checks.
+           If proc is given, it must also have exited successfully.
+        """
 
         max_time = time.time() + self.restart_timeout
         last_notify = time.time()
+        delay = 0.5
+        output = []
+        returncode = 0
 
         while time.time() < max_time:
+
+            if proc:
+                self._read_output(proc, output)
+                returncode = proc.poll()
+
+                # Pick up anything written between the read and the exit
+                if returncode is not None:
+                    self._read_output(proc, output)
+
+                if returncode:
+                    raise Exception('Error running init script (exit code {0}): {1}'.format(returncode, ''.join(output)))
+
             health_ok, health_text = self.get_health()
 
-            if health_ok and want_state == 'up':
-                return True
-            elif not health_ok and want_state == 'down':
+            if returncode == 0 and health_ok == (want_state == 'up'):
                 return True
 
             if (time.time() - last_notify) > 30:
@@ -130,7 +234,13 @@ class Solr(object):
                 time_left = int(5 * round(max_time - time.time()) / 5)
                 self.logger.info('Will wait up to {} more seconds for Solr to restart'.format(time_left))
 
-            time.sleep(2)
+            # Jitter keeps restarts on several hosts from polling in lockstep
+            time.sleep(min(delay + random.uniform(0, delay * 0.1), max(0, max_time - time.time())))
+            delay = min(delay * 1.7, 10.0)
+
+        if proc and proc.poll() is None:
+            self.logger.info('Init script is still running after {} seconds, stopping it'.format(self.restart_timeout))
+            self._stop_script(proc)
 
         self.logger.info('Solr did not come {} within {} seconds'.format(want_state, self.restart_timeout))
         return False
@@ -146,7 +256,12 @@ class Solr(object):
             raise Exception('set_properties: Invalid properties type: {0}'.format(config_type), tag=hostname)
 
     def _get_properties_files(self):
-        """Returns the list of core.properties files found under self.base_dir"""
+        """Returns the list of core.properties files found under self.base_dir.
+           The list is cached until set_properties() next rewrites the cores.
+        """
+
+        if self._properties_files:
+            return self._properties_files
 
         core_dirs = [os.path.join(self.base_dir, x) for x in os.listdir(self.base_dir) if os.path.isdir(os.path.join(self.base_dir, x))]
         properties_files = [os.path.join(x, 'core.properties') for x in core_dirs if os.path.isfile(os.path.join(x, 'core.properties'))]
@@ -154,36 +269,33 @@ class Solr(object):
         if not properties_files:
             raise Exception('No core.properites files found under {}'.format(self.base_dir))
 
+        self._properties_files = properties_files
         return properties_files
 
     def set_properties(self, config_type):
         """Set core.properties to enable either master or slave"""
 
+        # Pick up any cores that were added since the list was cached
+        self._properties_files = None
         properties_line = self._get_properties_config(config_type)
         properties_files = self._get_properties_files()
 
-        for properties_file in properties_files:
-
-            with open(properties_file, 'w') as f:
-                f.write(properties_line)
+        self._io_pool.map(functools.partial(_write_atomic, contents=properties_line), properties_files)
 
         return True
 
     def _check_core_config(self, config_type):
         """Read the core.properties files to determine whether or not this host is master or slave"""
 
-        properties_line = self._get_properties_config(config_type)
+        expected = self._get_properties_config(config_type).encode()
         properties_files = self._get_properties_files()
 
-        for properties_file in properties_files:
-
-            with open(properties_file, 'r') as f:
-                current_config = f.read()
-
-                if current_config != properties_line:
-                    return False
-
-        return True
+        try:
+            return all(self._io_pool.map(functools.partial(_read_and_compare, expected=expected), properties_files))
+        # A core was removed since the list was cached, so rescan next time
+        except OSError:
+            self._properties_files = None
+            raise
 
     def is_master(self):
         """Check whether this host is master"""
@@ -237,11 +349,14 @@ def parse():
     parser.add_argument('-p', '--port', type=int, default=8080, help='Solr API port (default: %(default)s)')
     parser.add_argument('-u', '--base-uri', default='/solr', help='Solr API path prefix (default: %(default)s)')
     parser.add_argument('-b', '--base-dir', default='/var/lib/tomcat7multi/solr/solr', help='Base directory for Solr cores (default: %(default)s)')
-    parser.add_argument('-i', '--check-interval', default='30s', help='Consul check timeout (default: %(default)s)')
+    parser.add_argument('-i', '--check-interval', default='30s', help='Consul check interval (default: %(default)s)')
+    parser.add_argument('-t', '--check-timeout', default='6s', help='Consul check timeout (default: %(default)s)')
+    parser.add_argument('-D', '--check-deregister', help='Deregister the service after its check has been critical for this long (default: never)')
+    parser.add_argument('-r', '--reassert-ticks', type=int, default=15, help='Re-check the master/slave configuration every this many monitor iterations when the role has not changed (default: %(default)s)')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse()
     solr_args = [args.port, args.base_uri, args.base_dir]
-    start_handler(Solr, solr_args, args.port, args.api_port, args.cluster_name, check_interval=args.check_interval)
+    start_handler(Solr, solr_args, args.port, args.api_port, args.cluster_name, check_interval=args.check_interval, reassert_ticks=args.reassert_ticks, check_timeout=args.check_timeout, check_deregister=args.check_deregister)
@@ -2,21 +2,85 @@ import os
 import sys
 import json
 import time
+import Queue
 import consul
+import random
 import signal
 import socket
 import logging
 import threading
 import SocketServer
-import SimpleHTTPServer
+import BaseHTTPServer
 
 from consul.base import ConsulException
+from requests.adapters import HTTPAdapter
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from requests.packages.urllib3.util.retry import Retry
 
+# inotify_simple is optional; without it the disable flag file is checked
+# with a stat on every monitor iteration
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
-class TCPServer(SocketServer.TCPServer):
-    """Allow port to be reused if it's still in TIME_WAIT"""
+
+# Hosts are expected to be named after their cluster plus a number, e.g. solr001
+_DEFAULT_CLUSTER = socket.gethostname().rstrip('0123456789')
+
+# How long a /health response is served from cache, in seconds
+_HEALTH_CACHE_TTL = 1.0
+
+_JSON_CONTENT_TYPE = 'Content-Type: application/json\r\n'
+
+# Longest time to wait before retrying the leader lock after failed attempts,
+# in seconds
+_ACQUIRE_BACKOFF_MAX = 8
+
+
+def consul_client():
+    """Return a Consul client that keeps its connections to the local agent
+       alive and retries requests that could not connect
+    """
+
+    client = consul.Consul()
+
+    # Only connection failures are retried: a request that reached the agent
+    # (e.g. a session create) must not be sent twice
+    retries = Retry(total=3, connect=3, read=0, backoff_factor=0.1)
+    client.http.session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries))
+
+    return client
+
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Handle each request in its own thread, so a slow health check does not
+       hold up other probes, and allow port to be reused if it's still in
+       TIME_WAIT
+    """
 
     allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+
+        SocketServer.TCPServer.__init__(self, *args, **kwargs)
+
+        # (timestamp, response) of the last /health response. It is replaced
+        # as a whole, so probes read it without locking, and only refreshes
+        # take the lock
+        self.health_cache = None
+        self.health_lock = threading.RLock()
+
+    def cached_health(self):
+        """Return the cached /health response if it is still fresh"""
+
+        cached = self.health_cache
+
+        # A negative age means the clock went backwards, so refresh
+        if cached and 0 <= time.time() - cached[0] < _HEALTH_CACHE_TTL:
+            return cached[1]
 
     def finish_request(self, request, client_address):
         """Override finish_request in order to ignore client disconnects"""
@@ -27,7 +91,7 @@ class TCPServer(SocketServer.TCPServer):
             pass
 
 
-class HTTPHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """API server"""
 
     def log_message(self, *args):
@@ -38,54 +102,102 @@ class HTTPHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     def do_GET(self):
         """Handle GET requests"""
 
-        args = self.path.split('/')[1:]
+        route = self.routes.get(self.path.split('?', 1)[0])
 
-        if not args:
-            self.send_error('No command specified')
-            return False
-
-        if args[0] == 'health':
-            state_ok, state_text = self.server.apphandler.health()
+        if route:
+            response = route(self)
         else:
-            state_ok, state_text = False, 'Unsupported endpoint'
+            response = self.build_response(404, 'Unsupported endpoint')
+
+        self.wfile.write(response)
+
+    def health_response(self):
+        """Return the application's health, cached for a short time"""
+
+        response = self.server.cached_health()
+
+        # Only one probe refreshes the cache, the others wait for its result
+        if not response:
+            with self.server.health_lock:
+                response = self.server.cached_health()
 
-        status_code = {True: 200}.get(state_ok, 500)
+                if not response:
+                    state_ok, state_text = self.server.apphandler.health()
+                    response = self.build_response({True: 200}.get(state_ok, 500), state_text)
+                    self.server.health_cache = (time.time(), response)
 
+        return response
+
+    def build_response(self, status_code, state_text):
+        """Return a complete HTTP response, so that it can be cached and sent
+           with a single write
+        """
+
+        # Fall back to plain text for anything that is not JSON serializable
         try:
             response_text = json.dumps(state_text) + '\n'
-        except:
+        except (TypeError, ValueError):
             response_text = str(state_text) + '\n'
 
-        self.send_response(status_code)
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
-        self.wfile.write(response_text)
+        return ''.join((
+            '{} {} {}\r\n'.format(self.protocol_version, status_code, self.responses[status_code][0]),
+            _JSON_CONTENT_TYPE,
+            'Content-Length: {}\r\n\r\n'.format(len(response_text)),
+            response_text,
+        ))
+
+    # Request paths, without the query string, mapped to their handlers
+    routes = {
+        '/health': health_response,
+        '/health/': health_response,
+    }
 
 
 class ConsulHandler(object):
 
-    def __init__(self, apphandler_class, apphandler_args, cluster_name, api_port, application_port, check_interval='30s', disable_flag_file='/var/tmp/consul_failover_disable'):
+    def __init__(self, apphandler, cluster_name, api_port, application_port, check_interval='30s', disable_flag_file='/var/tmp/consul_failover_disable', reassert_ticks=1, loop_interval=2, check_timeout=None, check_deregister=None):
 
-        self.apphandler = apphandler_class(*apphandler_args)
+        self.apphandler = apphandler
         self.cluster_name = cluster_name
         self.api_port = api_port
         self.application_port = application_port
         self.logger = logging.getLogger('ConsulFailover')
-        self.consul = consul.Consul()
-        self.health_check = consul.Check.http('http://127.0.0.1:{}/health'.format(self.api_port), check_interval)
+        self.consul = consul_client()
+        self.health_check = consul.Check.http('http://127.0.0.1:{}/health'.format(self.api_port), check_interval, timeout=check_timeout, deregister=check_deregister)
         self.disable_flag_file = disable_flag_file
+        self.reassert_ticks = reassert_ticks
+        self.loop_interval = loop_interval
+        self._hostname = socket.gethostname()
+        self._leader_key = 'lock/{}/leader'.format(cluster_name)
+        self._service_check_key = 'service:{}'.format(cluster_name)
+        self._leader_index = None
+        self._current_tag = None
+        self._last_role = None
+        self._last_leader = None
+        self._ticks_since_ensure = 0
+        self._disable_flag_present = None
+        self._acquire_fail_count = 0
+        self._next_acquire_at = 0
+
+        # Used to query the Consul agent concurrently
+        self._pool = ThreadPool(2)
+
+        # Holds the latest role for the ensure worker; a newer role replaces
+        # one that has not been picked up yet
+        self._ensure_queue = Queue.Queue(maxsize=1)
 
     def get_existing_session(self):
         """Return an existing Consul session if there is one"""
 
-        existing_sessions = self.consul.session.node(socket.gethostname(), consistency='consistent')[1]
-        leader_sessions = [x for x in existing_sessions if x['Name'] == self.cluster_name]
+        existing_sessions = self.consul.session.node(self._hostname, consistency='consistent')[1]
+        leader_sessions = (x for x in existing_sessions if x['Name'] == self.cluster_name)
+        leader_session = next(leader_sessions, None)
 
-        if leader_sessions and len(leader_sessions) != 1:
+        if next(leader_sessions, None):
             raise Exception('Multiple {} leader sessions found'.format(self.cluster_name))
 
-        if leader_sessions:
-            return leader_sessions[0]['ID']
+        if leader_session:
+            return leader_session['ID']
 
     def get_session(self):
         """Get an existing session, or create one if one does not exist"""
@@ -96,7 +208,7 @@ class ConsulHandler(object):
         if session:
             return session
 
-        session_checks = ['serfHealth', 'service:{}'.format(self.cluster_name)]
+        session_checks = ['serfHealth', self._service_check_key]
 
         while True:
 
@@ -106,10 +218,13 @@ class ConsulHandler(object):
                 self.logger.info('Error creating session: {}'.format(e))
                 time.sleep(2)
 
-    def register(self):
-        """Register service in consul"""
+    def register(self, services=None):
+        """Register service in consul, optionally using an already fetched
+           list of the agent's services
+        """
 
-        services = self.consul.agent.services()
+        if services is None:
+            services = self.consul.agent.services()
 
         # Take no action the service is already registered and has the correct tag
         if self.cluster_name in services:
@@ -117,13 +232,25 @@ class ConsulHandler(object):
 
         self.logger.info('Registering service in Consul')
         self.consul.agent.service.register(self.cluster_name, port=self.application_port, check=self.health_check)
-        # Give the Consul agent time to find our registration
-        time.sleep(1)
 
-    def deregister(self):
+        # Sessions can only be created once the catalog knows about our
+        # check, so wait briefly for the agent to sync it
+        for _ in range(20):
+            try:
+                node_checks = self.consul.health.node(self._hostname)[1]
+            except ConsulException:
+                node_checks = []
+
+            if any(x['CheckID'] == self._service_check_key for x in node_checks):
+                break
+
+            time.sleep(0.05)
+
+    def deregister(self, services=None):
         """Deregister a service in Consul"""
 
-        services = self.consul.agent.services()
+        if services is None:
+            services = self.consul.agent.services()
 
         # Take no action if the service is not currently registered
         if not self.cluster_name in services:
@@ -138,17 +265,22 @@ class ConsulHandler(object):
         self.logger.info('Deregistering service in Consul')
         return self.consul.agent.service.deregister(self.cluster_name)
 
-    def set_tag(self, tag):
-        """Register a service in Consul with a tag"""
+    def set_tag(self, tag, services=None):
+        """Register a service in Consul with a tag, optionally using an
+           already fetched list of the agent's services
+        """
 
-        services = self.consul.agent.services()
+        if services is None:
+            services = self.consul.agent.services()
 
         # Take no action if the service is already registered and has the correct tag
         if self.cluster_name in services and services[self.cluster_name]['Tags'] == [tag]:
+            self._current_tag = tag
             return
 
         self.logger.info('Updating tag to {}'.format(tag))
         self.consul.agent.service.register(self.cluster_name, port=self.application_port, check=self.health_check, tags=[tag])
+        self._current_tag = tag
 
         return True
 
@@ -156,35 +288,96 @@ class ConsulHandler(object):
         """Get the tag that is currently set for this service in Consul"""
 
         services = self.consul.catalog.service(self.cluster_name)[1]
-        my_services = [x for x in services if x['Node'] == socket.gethostname()]
+        my_service = next((x for x in services if x['Node'] == self._hostname), None)
+
+        if my_service and my_service['ServiceTags']:
+            return my_service['ServiceTags'][0]
+
+    def wait_for_leader_lock(self, wait):
+        """Wait up to the given Consul wait time for the leader lock to change
+           and return the ID of the session that holds it, if any
+        """
+
+        try:
+            index, leader_lock = self.consul.kv.get(self._leader_key, index=self._leader_index, wait=wait)
+        except ConsulException as e:
+            self.logger.info('Error watching leader lock: {}'.format(e))
+            self._leader_index = None
+            time.sleep(2)
+            return
+
+        # Consul indexes only move forward unless its state was reset, in
+        # which case the watch has to start over
+        if self._leader_index and int(index) < int(self._leader_index):
+            index = None
+
+        self._leader_index = index
+
+        if leader_lock:
+            return leader_lock.get('Session')
+
+    def acquire_leader_lock(self, session):
+        """Try to take the leader lock, backing off with jitter after failed
+           attempts, e.g. while Consul's lock delay is in effect
+        """
+
+        if self.acquire_backing_off():
+            return False
+
+        if self.consul.kv.put(self._leader_key, value='', acquire=session):
+            self.reset_acquire_backoff()
+            return True
+
+        self._acquire_fail_count += 1
+        delay = min(_ACQUIRE_BACKOFF_MAX, 2 ** self._acquire_fail_count) * (0.5 + random.random())
+        self._next_acquire_at = time.time() + delay
+        return False
+
+    def acquire_backing_off(self):
+        """Check whether leader lock attempts are being held back after a
+           failed attempt
+        """
+
+        # A wait longer than the backoff allows means the clock went backwards
+        return 0 < self._next_acquire_at - time.time() <= _ACQUIRE_BACKOFF_MAX * 1.5
 
-        if my_services and my_services[0]['ServiceTags']:
-            return my_services[0]['ServiceTags'][0]
+    def reset_acquire_backoff(self):
+        """Allow the next leader lock attempt to be made straight away"""
 
-    def get_leader(self):
-        """Determine the cluster leader"""
+        self._acquire_fail_count = 0
+        self._next_acquire_at = 0
 
-        leader_lock = self.consul.kv.get('lock/{}/leader'.format(self.cluster_name))
-        leader_session = leader_lock[1].get('Session')
+    def get_leader(self, leader_session=None):
+        """Determine the cluster leader, optionally from an already known
+           leader session
+        """
+
+        if not leader_session:
+            leader_lock = self.consul.kv.get(self._leader_key)
+            leader_session = leader_lock[1].get('Session')
 
         if not leader_session:
             return
 
+        # session.info returns no session data if the session does not exist
         try:
             return self.consul.session.info(leader_session)[1]['Node']
-        except:
+        except (ConsulException, KeyError, TypeError):
             raise Exception('{} is leader-locked by invalid session ID: {}'.format(self.cluster_name, leader_session))
 
-    def is_healthy(self):
-        """Get the health of this service as reported by Consul"""
+    def is_healthy(self, checks=None):
+        """Get the health of this service as reported by Consul, optionally
+           using an already fetched list of the agent's checks
+        """
 
-        checks = self.consul.agent.checks()
+        if checks is None:
+            checks = self.consul.agent.checks()
 
         if not checks:
             self.logger.info('Consul agent does not have any health checks')
             return False
 
-        check = checks.get('service:{}'.format(self.cluster_name))
+        check = checks.get(self._service_check_key)
 
         if not check:
             self.logger.info('Consul agent does not have a health check for service "{}"'.format(self.cluster_name))
@@ -195,18 +388,153 @@ class ConsulHandler(object):
         check_state = {'passing': True}.get(consul_status, False)
         return check_state
 
+    def watch_disable_flag(self):
+        """Track the disable flag file with inotify, if available, so that
+           monitor does not have to stat it on every iteration
+        """
+
+        if not inotify_simple:
+            return
+
+        flags = inotify_simple.flags
+        flag_dir, flag_name = os.path.split(self.disable_flag_file)
+        inotify = None
+
+        try:
+            inotify = inotify_simple.INotify()
+            inotify.add_watch(flag_dir, flags.CREATE | flags.DELETE | flags.MOVED_TO | flags.MOVED_FROM)
+        except (OSError, IOError) as e:
+            self.logger.info('Unable to watch {}, falling back to polling: {}'.format(flag_dir, e))
+
+            if inotify:
+                inotify.close()
+
+            return
+
+        def read_events():
+            try:
+                while True:
+                    for event in inotify.read():
+                        # The watch is gone, so no further events will arrive
+                        if event.mask & flags.IGNORED:
+                            self.logger.info('Watch on {} was removed, falling back to polling'.format(flag_dir))
+                            self._disable_flag_present = None
+                            inotify.close()
+                            return
+
+                        # Events were dropped, so the flag may be stale;
+                        # check the file again and carry on watching
+                        if event.mask & flags.Q_OVERFLOW:
+                            self._disable_flag_present = os.path.exists(self.disable_flag_file)
+                        elif event.name == flag_name:
+                            self._disable_flag_present = bool(event.mask & (flags.CREATE | flags.MOVED_TO))
+            except Exception as e:
+                self.logger.info('Stopped watching {}, falling back to polling: {}'.format(flag_dir, e))
+                self._disable_flag_present = None
+
+        # Check for the file only once the watch exists, so no change is missed
+        self._disable_flag_present = os.path.exists(self.disable_flag_file)
+        thread = threading.Thread(target=read_events)
+        thread.daemon = True
+        thread.start()
+
+    def is_disabled(self):
+        """Check whether the disable flag file exists"""
+
+        if self._disable_flag_present is None:
+            return os.path.exists(self.disable_flag_file)
+
+        return self._disable_flag_present
+
+    def track_role(self, role, leader=None):
+        """Record this host's role and return whether the application handler
+           needs to be told about it, either because the role or leader has
+           changed or because reassert_ticks iterations have passed since it
+           was last told
+        """
+
+        self._ticks_since_ensure += 1
+
+        if (role, leader) == (self._last_role, self._last_leader) and self._ticks_since_ensure < self.reassert_ticks:
+            return False
+
+        self._last_role = role
+        self._last_leader = leader
+        self._ticks_since_ensure = 0
+        return True
+
+    def queue_ensure(self, role, leader=None):
+        """Hand a role to the ensure worker, replacing any role it has not
+           started on yet
+        """
+
+        try:
+            self._ensure_queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+        self._ensure_queue.put_nowait((role, leader))
+
+    def ensure_worker(self):
+        """Call ensure_master() and ensure_slave() off the monitor thread, so
+           that a slow reconfiguration does not stop Consul from being polled
+        """
+
+        while True:
+            role, leader = self._ensure_queue.get()
+
+            try:
+                if role == 'master':
+                    self.apphandler.ensure_master()
+                elif role == 'slave':
+                    self.apphandler.ensure_slave(leader)
+            except Exception as e:
+                self.logger.exception('Error ensuring {} role: {}'.format(role, e))
+
     def monitor(self):
         """Monitor service and report status to Consul"""
 
         signal.signal(signal.SIGINT, self.graceful_exit)
         signal.signal(signal.SIGTERM, self.graceful_exit)
+        self.watch_disable_flag()
+        thread = threading.Thread(target=self.ensure_worker)
+        thread.daemon = True
+        thread.start()
         self.register()
         last_health = None
+        next_tick = time.time()
 
         while True:
-            time.sleep(2)
+            # Keep to a fixed schedule, so that time spent in the loop body does
+            # not stretch the period. Waking early for a lock change keeps the
+            # current tick, while an overrun or a clock jump starts over
+            now = time.time()
+
+            if now >= next_tick:
+                next_tick += self.loop_interval
+
+            if not now < next_tick <= now + self.loop_interval:
+                next_tick = now + self.loop_interval
+
+            # Wake up early if the leader lock changes hands. Consul treats a
+            # zero wait as its default of five minutes, so never ask for one
+            leader_session = self.wait_for_leader_lock('{}ms'.format(max(100, int((next_tick - now) * 1000))))
+
+            # Fetch the agent's checks and services concurrently, once per
+            # iteration. python-consul sets no HTTP timeout and an unbounded
+            # get() cannot be interrupted by signals on Python 2, so a stalled
+            # agent must not block the loop for longer than a few seconds
+            checks = self._pool.apply_async(self.consul.agent.checks)
+            services = self._pool.apply_async(self.consul.agent.services)
+            timeout = self.loop_interval + 5
+
+            try:
+                checks, services = checks.get(timeout), services.get(timeout)
+            except (TimeoutError, ConsulException) as e:
+                self.logger.info('Error querying the Consul agent: {}'.format(str(e) or 'timed out'))
+                continue
 
-            is_healthy = self.is_healthy()
+            is_healthy = self.is_healthy(checks)
 
             # Log health state changes for clarity
             if is_healthy != last_health:
@@ -215,28 +543,51 @@ class ConsulHandler(object):
                 self.logger.info('Service is {}'.format(health_text))
 
             if not is_healthy:
-                self.set_tag('unhealthy')
+                self.set_tag('unhealthy', services)
+
+                # The worker takes no action for this role, but queueing it
+                # drops any master or slave role that is still pending
+                if self.track_role('unhealthy'):
+                    self.queue_ensure('unhealthy')
+
                 continue
 
-            if os.path.exists(self.disable_flag_file):
+            if self.is_disabled():
 
-                if not self.get_tag() == 'disabled':
+                if not self._current_tag == 'disabled':
                     self.logger.info('Disabling service because {} exists'.format(self.disable_flag_file))
 
-                self.set_tag('disabled')
+                self.set_tag('disabled', services)
+
+                if self.track_role('disabled'):
+                    self.queue_ensure('disabled')
+
                 continue
 
-            # Attempt to lock, and become the master if it works
-            if self.consul.kv.put('lock/{}/leader'.format(self.cluster_name), value='', acquire=self.get_session()):
-                self.set_tag('master')
-                self.apphandler.ensure_master()
+            # Wait quietly while backing off from a free lock; the lock watch
+            # wakes the loop as soon as another node takes it
+            if not leader_session and self.acquire_backing_off():
+                continue
+
+            session = self.get_session()
+
+            # Stay master if we already hold the lock, or attempt to lock if
+            # it is free and become the master if it works
+            if leader_session == session or (not leader_session and self.acquire_leader_lock(session)):
+                self.set_tag('master', services)
+
+                if self.track_role('master'):
+                    self.queue_ensure('master')
             # Otherwise become a slave to the master
             else:
-                leader = self.get_leader()
+                leader = self.get_leader(leader_session)
 
                 if leader:
-                    self.set_tag('slave')
-                    self.apphandler.ensure_slave(leader)
+                    self.reset_acquire_backoff()
+                    self.set_tag('slave', services)
+
+                    if self.track_role('slave', leader):
+                        self.queue_ensure('slave', leader)
                 else:
                     self.logger.info('Unable to lock and unable to determine leader, retrying...')
 
@@ -245,7 +596,7 @@ class ConsulHandler(object):
         sys.exit(0)
 
 
-def start_handler(apphandler_class, apphandler_args, application_port, api_port, cluster_name=socket.gethostname().rstrip('0123456789'), log_level='INFO', check_interval='30s'):
+def start_handler(apphandler_class, apphandler_args, application_port, api_port, cluster_name=_DEFAULT_CLUSTER, log_level='INFO', check_interval='30s', reassert_ticks=1, check_timeout=None, check_deregister=None):
     """Set up an application for Consul failover"""
 
     logger = logging.getLogger('ConsulFailover')
@@ -255,11 +606,14 @@ def start_handler(apphandler_class, apphandler_args, application_port, api_port,
     loghandler.setFormatter(logformatter)
     logger.addHandler(loghandler)
 
-    consulhandler = ConsulHandler(apphandler_class, apphandler_args, cluster_name, api_port, application_port, check_interval)
+    # The monitor and the API server share one application handler, so its
+    # connections and setup are not duplicated
+    apphandler = apphandler_class(*apphandler_args)
+    consulhandler = ConsulHandler(apphandler, cluster_name, api_port, application_port, check_interval, reassert_ticks=reassert_ticks, check_timeout=check_timeout, check_deregister=check_deregister)
 
     # Start API server
     apiserver = TCPServer(('', api_port), HTTPHandler)
-    apiserver.apphandler = apphandler_class(*apphandler_args)
+    apiserver.apphandler = consulhandler.apphandler
     thread = threading.Thread(target=apiserver.serve_forever)
     thread.daemon = True
     thread.start()
@@ -18,6 +18,7 @@ setup(
     install_requires=[
         'python-consul',
         'python-mysqldb',
+        'requests',
     ],
     scripts=[
         'bin/mysql-consul.py',